@@ -1,32 +1,65 @@
 # app.py
 from celery import Celery
+from celery.signals import task_postrun, worker_process_init
 from flask import Flask, request, jsonify, redirect
-from weasyprint import HTML
-from jinja2 import Template
-from datetime import datetime
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import boto3
-from botocore.exceptions import NoCredentialsError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import io
 import os
 import gc
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import time
 import logging
+from functools import lru_cache
+import orjson
 import replicate
 from flask_cors import CORS
+from flask_compress import Compress
 
 # Import our new modules
 from config import CELERY_CONFIG, FLASK_CONFIG, STORAGE_CONFIG, API_CONFIG, BASE_URLS
-from utils import sanitize_filename, get_s3_key, log_memory_usage, build_story_prompt
+from utils import sanitize_filename, get_s3_key, get_content_s3_key, log_memory_usage, build_story_prompt
 from story_generator import StoryGenerator
 from language_handler import get_language_config, format_language_strings
+from pdf_renderer import render_pdf, prefetch_image, warm_up as warm_up_pdf_renderer
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['CELERY_BROKER_URL'] = CELERY_CONFIG['BROKER_URL']
 app.config['CELERY_RESULT_BACKEND'] = CELERY_CONFIG['RESULT_BACKEND']
 app.config['MAX_CONTENT_LENGTH'] = FLASK_CONFIG['MAX_CONTENT_LENGTH']
+app.config['COMPRESS_ALGORITHM'] = FLASK_CONFIG['COMPRESS_ALGORITHM']
+app.config['COMPRESS_MIMETYPES'] = FLASK_CONFIG['COMPRESS_MIMETYPES']
+app.config['COMPRESS_MIN_SIZE'] = FLASK_CONFIG['COMPRESS_MIN_SIZE']
 
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'], 
                 backend=app.config['CELERY_RESULT_BACKEND'])
 celery.conf.broker_connection_retry_on_startup = CELERY_CONFIG['BROKER_CONNECTION_RETRY_ON_STARTUP']
+celery.conf.update(
+    task_serializer=CELERY_CONFIG['SERIALIZER'],
+    result_serializer=CELERY_CONFIG['SERIALIZER'],
+    accept_content=CELERY_CONFIG['ACCEPT_CONTENT'],
+    result_compression=CELERY_CONFIG['RESULT_COMPRESSION'],
+    worker_max_tasks_per_child=CELERY_CONFIG['MAX_TASKS_PER_CHILD'],
+    worker_max_memory_per_child=CELERY_CONFIG['MAX_MEMORY_PER_CHILD'],
+    worker_prefetch_multiplier=CELERY_CONFIG['PREFETCH_MULTIPLIER'],
+    task_acks_late=CELERY_CONFIG['ACKS_LATE'],
+    task_reject_on_worker_lost=CELERY_CONFIG['REJECT_ON_WORKER_LOST']
+)
 
+Compress(app)
 CORS(app, resources={r"/*": {"origins": FLASK_CONFIG['CORS_ORIGINS']}}, supports_credentials=True)
 logging.basicConfig(level=logging.INFO)
 
@@ -47,20 +80,76 @@ if not all(API_KEYS.values()):
 replicate_client = replicate.Client(api_token=API_KEYS["replicate"])
 story_generator = StoryGenerator(API_KEYS["mistral"], replicate_client)
 
-def generate_presigned_url(bucket_name, s3_key, expiration=3600):
+# Compile the story template once per process instead of once per task
+os.makedirs(STORAGE_CONFIG['TEMPLATE_CACHE_DIR'], exist_ok=True)
+template_env = Environment(
+    loader=FileSystemLoader(os.path.dirname(os.path.abspath(__file__))),
+    bytecode_cache=FileSystemBytecodeCache(STORAGE_CONFIG['TEMPLATE_CACHE_DIR']),
+    auto_reload=False
+)
+STORY_TEMPLATE = template_env.get_template("story_template.html")
+
+# Status polling always answers in English, so format those strings once
+STATUS_MESSAGES = format_language_strings(get_language_config('english'), {'name': '', 'author': ''})
+
+@lru_cache(maxsize=1024)
+def _sign_pdf_url(bucket_name, s3_key, expiration, window):
+    """Sign a PDF URL; `window` only partitions the cache so entries roll over."""
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': bucket_name,
+            'Key': s3_key,
+            'ResponseContentType': 'application/pdf',
+            'ResponseContentDisposition': 'inline'
+        },
+        ExpiresIn=expiration
+    )
+
+def generate_presigned_url(bucket_name, s3_key, expiration=API_CONFIG['URL_EXPIRATION']):
+    """
+    Generate a pre-signed URL for a PDF.
+    URLs are reused within half of their lifetime, so every URL handed out
+    stays valid for at least expiration / 2 seconds.
+    """
     try:
         expiration = int(expiration)
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket_name, 'Key': s3_key},
-            ExpiresIn=expiration
-        )
+        window = int(time.time() // max(expiration // 2, 1))
+        presigned_url = _sign_pdf_url(bucket_name, s3_key, expiration, window)
         logging.info(f"✅ Generated pre-signed URL with {expiration}s expiration")
         return presigned_url
     except Exception as e:
         logging.error(f"❌ Error generating pre-signed URL: {str(e)}")
         return None
 
+def pdf_exists(bucket_name, s3_key):
+    """Check whether an object is already stored under the given key."""
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def upload_pdf(pdf_bytes, bucket_name, s3_key):
+    """Upload PDF bytes with one PUT, only using multipart for large files."""
+    extra_args = {
+        'ContentType': 'application/pdf',
+        'ContentDisposition': 'inline'
+    }
+    threshold = STORAGE_CONFIG['MULTIPART_THRESHOLD']
+    if len(pdf_bytes) < threshold:
+        s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=pdf_bytes, **extra_args)
+    else:
+        s3_client.upload_fileobj(
+            io.BytesIO(pdf_bytes),
+            bucket_name,
+            s3_key,
+            ExtraArgs=extra_args,
+            Config=TransferConfig(multipart_threshold=threshold)
+        )
+
 @app.after_request
 def add_headers(response):
     response.headers.update({
@@ -71,6 +160,32 @@ def add_headers(response):
     })
     return response
 
+def illustrate_section(section, chapter_label, prefetch=True):
+    """Summarize (if needed) and illustrate a single story section."""
+    story_generator.summarize_section(section)
+    # Use the section's own title and summary (or fallback)
+    chapter_title = section.get('title') or f"{chapter_label} {section.get('chapter_number')}"
+    chapter_summary = section.get('summary') or section.get('content')[:100]
+    illustration_prompt = (
+        f"Create a whimsical storybook-style illustration for the chapter titled '{chapter_title}'. "
+        f"Capture the scene where {chapter_summary}. "
+        "Use bright colors and a cohesive visual style that matches the rest of the story."
+    )
+    illustration_url = story_generator.generate_illustration(illustration_prompt)
+    # Download now, in parallel with the other sections, so rendering never waits on the network
+    image = None
+    if illustration_url and prefetch:
+        try:
+            image = prefetch_image(illustration_url)
+        except Exception as e:
+            logging.warning(f"⚠️ Illustration prefetch failed, WeasyPrint will fetch it: {str(e)}")
+    return {
+        "url": illustration_url,
+        "image": image,
+        # You can decide what to display as the caption
+        "caption": chapter_title  # e.g. show the chapter title as the caption
+    }
+
 @celery.task
 def generate_entire_story_task(data):
     """
@@ -80,7 +195,9 @@ def generate_entire_story_task(data):
       3. Generating an illustration for each section (using Replicate)
       4. Rendering the final HTML using a Jinja2 template
       5. Converting the HTML to PDF (using WeasyPrint)
-      6. Uploading the PDF to S3 and returning a pre-signed URL
+      6. Uploading the PDF to S3 and returning its location
+    The pre-signed URL is generated when the status endpoint is polled.
+    With "output-format": "json" the task stops after step 3 and returns the story.
     """
     try:
         story_language = data.get('story-language', 'English').lower()
@@ -96,39 +213,55 @@ def generate_entire_story_task(data):
         logging.info(f"formatted_lang: {formatted_lang}")
         prompt = build_story_prompt(data, formatted_lang)  # This is in English
 
-        # Pass the user’s language so Mistral responds in that language
-        full_story = story_generator.generate_story(
-            prompt,
-            formatted_lang['chapter_label'],
-            story_length=data.get('story_length', 'short'),
-            target_language=story_language  # e.g. "french", "spanish", etc.
-        )
+        chapter_label = formatted_lang['chapter_label']
+        wants_pdf = data.get('output-format', 'pdf') != 'json'
+        early_sections = {}
 
-        # --- Split Story and Generate Illustrations ---
-        sections = story_generator.split_into_sections(full_story, formatted_lang['chapter_label'])
-        illustrations = []
-        for section in sections:
-            # Use the section's own title and summary (or fallback)
-            chapter_title = section.get('title') or f"{formatted_lang['chapter_label']} {section.get('chapter_number')}"
-            chapter_summary = section.get('summary') or section.get('content')[:100]
-            illustration_prompt = (
-                f"Create a whimsical storybook-style illustration for the chapter titled '{chapter_title}'. "
-                f"Capture the scene where {chapter_summary}. "
-                "Use bright colors and a cohesive visual style that matches the rest of the story."
+        with ThreadPoolExecutor(max_workers=API_CONFIG['MAX_CONCURRENT_REQUESTS']) as executor:
+            def illustrate_early(index, section):
+                """Start on a finished chapter while the rest of the story is still streaming."""
+                early_sections[index] = (section, executor.submit(illustrate_section, section, chapter_label, wants_pdf))
+
+            # Pass the user’s language so Mistral responds in that language
+            full_story = story_generator.generate_story(
+                prompt,
+                chapter_label,
+                story_length=data.get('story_length', 'short'),
+                target_language=story_language,  # e.g. "french", "spanish", etc.
+                on_chapter=illustrate_early
             )
-            illustration_url = story_generator.generate_illustration(illustration_prompt)
-            illustrations.append({
-                "url": illustration_url,
-                # You can decide what to display as the caption
-                "caption": chapter_title  # e.g. show the chapter title as the caption
-            })
+
+            # --- Split Story and Generate Illustrations ---
+            # Summaries are produced per section alongside its illustration
+            sections = story_generator.split_into_sections(full_story, chapter_label, summarize=False)
+            futures = []
+            for index, section in enumerate(sections):
+                if index in early_sections:
+                    early_section, future = early_sections[index]
+                    futures.append((early_section, future))
+                else:
+                    futures.append((section, executor.submit(illustrate_section, section, chapter_label, wants_pdf)))
+            illustrations = [future.result() for _, future in futures]
+            for section, (illustrated_section, _) in zip(sections, futures):
+                section["summary"] = illustrated_section["summary"]
+
+        # JSON clients render the story themselves, so skip WeasyPrint and S3 entirely.
+        # Illustration URLs are Replicate delivery links; one served from the illustration
+        # cache may be up to ILLUSTRATION_TTL old and expire soon after, so fetch it promptly.
+        if not wants_pdf:
+            return {
+                "title": formatted_lang['story_title'],
+                "author": formatted_lang['by_author'],
+                "sections": sections,
+                "illustrations": [
+                    {"url": illustration["url"], "caption": illustration["caption"]}
+                    for illustration in illustrations
+                ]
+            }
 
         # --- Render PDF from Template ---
         log_memory_usage("Before PDF Generation")
-        with open("story_template.html") as template_file:
-            template = Template(template_file.read())
-
-        rendered_html = template.render(
+        rendered_html = STORY_TEMPLATE.render(
             title=formatted_lang['story_title'],
             author=formatted_lang['by_author'],
             content=full_story,
@@ -139,64 +272,86 @@ def generate_entire_story_task(data):
             end_text=formatted_lang['end_text'],
             no_illustrations_text=formatted_lang['no_illustrations'],
         )
+        # WeasyPrint reads the prefetched images from memory instead of downloading them again.
+        # They are moved out of the illustration results so this dict is their only owner.
+        prefetched_images = {}
+        for illustration in illustrations:
+            image = illustration.pop("image")
+            if image:
+                prefetched_images[illustration["url"]] = image
 
         # --- Generate PDF and Upload to S3 ---
-        pdf_dir = "/tmp"
-        os.makedirs(pdf_dir, exist_ok=True)
-        pdf_filename = f"{sanitize_filename(data.get('childName', 'child'))}_story.pdf"
-        pdf_path = os.path.join(pdf_dir, pdf_filename.strip().replace(' ', '_'))
-        HTML(string=rendered_html).write_pdf(pdf_path)
-        logging.info(f"✅ PDF successfully saved: {pdf_path}")
-
         bucket_name = os.getenv("S3_BUCKET_NAME")
         if not bucket_name:
             raise ValueError("❌ ERROR: S3_BUCKET_NAME environment variable is missing!")
-        date_prefix = datetime.utcnow().strftime('%Y-%m-%d')
-        s3_key = f"pdfs/{date_prefix}/{pdf_filename.strip().replace(' ', '_')}"
+        pdf_filename = f"{sanitize_filename(data.get('childName', 'child'))}_story.pdf"
+        s3_key = get_s3_key(pdf_filename)
 
-        s3_client.upload_file(
-            pdf_path,
-            bucket_name,
-            s3_key,
-            ExtraArgs={
-                'ContentType': 'application/pdf',
-                'ContentDisposition': 'inline'
-            }
-        )
+        # Identical HTML renders to an identical PDF, so store PDFs by content hash
+        content_key = get_content_s3_key(hashlib.sha256(rendered_html.encode()).hexdigest())
+        try:
+            stored = pdf_exists(bucket_name, content_key)
+        except ClientError as e:
+            # Without s3:ListBucket a missing key answers 403; rendering again is always safe
+            logging.warning(f"⚠️ Could not check s3://{bucket_name}/{content_key}, rendering anyway: {str(e)}")
+            stored = False
+        if stored:
+            logging.info(f"♻️ Reusing stored PDF s3://{bucket_name}/{content_key}")
+        else:
+            pdf_bytes = render_pdf(rendered_html, prefetched=prefetched_images)
+            prefetched_images.clear()  # the images are embedded now; free them before the upload
+            logging.info(f"✅ PDF successfully rendered: {len(pdf_bytes)} bytes")
+            upload_pdf(pdf_bytes, bucket_name, content_key)
 
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': bucket_name,
-                'Key': s3_key,
-                'ResponseContentType': 'application/pdf',
-                'ResponseContentDisposition': 'inline'
-            },
-            ExpiresIn=3600
+        # Server-side copy keeps the dated key that /download resolves. Every new PDF is
+        # therefore stored twice and neither copy is deleted here: the bucket needs a
+        # lifecycle rule expiring objects under S3_PDF_PREFIX once download links lapse.
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=s3_key,
+            CopySource={'Bucket': bucket_name, 'Key': content_key}
         )
-        logging.info(f"✅ Pre-signed URL generated: {presigned_url}")
-        return presigned_url
+
+        logging.info(f"✅ PDF uploaded to s3://{bucket_name}/{content_key}")
+        return {"bucket": bucket_name, "key": content_key}
 
     except Exception as e:
         logging.error(f"❌ generate_entire_story_task failed: {str(e)}")
         raise
 
+@worker_process_init.connect
+def init_pdf_renderer(**kwargs):
+    """Pay WeasyPrint's font and parser start-up once per worker process."""
+    try:
+        warm_up_pdf_renderer()
+    except Exception as e:
+        logging.warning(f"⚠️ PDF renderer warm-up failed: {str(e)}")
+
+@task_postrun.connect
+def collect_garbage(**kwargs):
+    """Reclaim PDF rendering memory between tasks, off the request path."""
+    gc.collect()
+
 @app.route('/task-status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     task = generate_entire_story_task.AsyncResult(task_id)
-    lang_config = get_language_config('english')
-    formatted_lang = format_language_strings(lang_config, {'name': '', 'author': ''})
-    
+
     if task.state == "PENDING":
-        return jsonify({"status": "pending", "message": formatted_lang['loading_message']})
+        return jsonify({"status": "pending", "message": STATUS_MESSAGES['loading_message']})
     elif task.state == "SUCCESS":
-        result = task.result  # This should be the S3 URL
-        if result:
-            return jsonify({"status": "completed", "pdf_url": result, "message": formatted_lang['success_message']})
+        result = task.result  # S3 location of the PDF, or the story itself for JSON output
+        if isinstance(result, dict) and "sections" in result:
+            return jsonify({"status": "completed", "story": result, "message": STATUS_MESSAGES['success_message']})
+        if isinstance(result, dict):
+            pdf_url = generate_presigned_url(result["bucket"], result["key"], expiration=API_CONFIG['URL_EXPIRATION'])
+        else:
+            pdf_url = result  # results stored before the S3 location was returned are the URL itself
+        if pdf_url:
+            return jsonify({"status": "completed", "pdf_url": pdf_url, "message": STATUS_MESSAGES['success_message']})
         else:
-            return jsonify({"status": "error", "message": formatted_lang['error_message']}), 500
+            return jsonify({"status": "error", "message": STATUS_MESSAGES['error_message']}), 500
     else:
-        return jsonify({"status": task.state, "message": formatted_lang['processing_message']})
+        return jsonify({"status": task.state, "message": STATUS_MESSAGES['processing_message']})
 
 @app.route('/api/generate-story', methods=['POST'])
 def generate_story_route():
@@ -206,17 +361,19 @@ def generate_story_route():
         logging.info(f"Received Data: {data}")
         # Immediately enqueue the Celery task
         task = generate_entire_story_task.delay(data)
-        return jsonify({
+        response = {
             "status": "pending",
             "message": "Your story is being generated...",
-            "task_id": task.id,
-            "pdf_url": f"{BASE_URLS['DOWNLOAD']}/{sanitize_filename(data.get('childName', 'child'))}_story.pdf"
-        })
+            "task_id": task.id
+        }
+        # JSON output never uploads a PDF, so there is nothing to link to
+        if data.get('output-format', 'pdf') != 'json':
+            response["pdf_url"] = f"{BASE_URLS['DOWNLOAD']}/{sanitize_filename(data.get('childName', 'child'))}_story.pdf"
+        return jsonify(response)
     except Exception as e:
         logging.error(f"Error in generate_story_route: {str(e)}")
         return jsonify({"status": "error", "message": "An error occurred while processing your request."}), 500
     finally:
-        gc.collect()
         log_memory_usage("After Request Cleanup")
 
 @app.route('/download/<filename>')
@@ -225,18 +382,17 @@ def download_file(filename):
         bucket_name = os.getenv("S3_BUCKET_NAME")
         if not bucket_name:
             raise ValueError("S3_BUCKET_NAME environment variable is missing!")
-        date_prefix = datetime.utcnow().strftime('%Y-%m-%d')
-        s3_key = f"pdfs/{date_prefix}/{filename.strip().replace(' ', '_')}"
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': bucket_name,
-                'Key': s3_key,
-                'ResponseContentType': 'application/pdf',
-                'ResponseContentDisposition': 'inline'
-            },
-            ExpiresIn=3600
-        )
+        filename = sanitize_filename(filename)
+        if not filename.endswith(".pdf") or filename.startswith(".") or "\\" in filename:
+            return jsonify({"status": "error", "message": "Invalid filename"}), 400
+        s3_key = get_s3_key(filename)
+        try:
+            if not pdf_exists(bucket_name, s3_key):
+                return jsonify({"status": "error", "message": "PDF not found"}), 404
+        except ClientError as e:
+            # Cannot tell (e.g. 403 without s3:ListBucket); S3 answers the signed URL itself
+            logging.warning(f"⚠️ Could not check s3://{bucket_name}/{s3_key}: {str(e)}")
+        presigned_url = generate_presigned_url(bucket_name, s3_key, expiration=API_CONFIG['URL_EXPIRATION'])
         if presigned_url:
             return redirect(presigned_url)
         else:
@@ -0,0 +1,38 @@
+import hashlib
+import logging
+import redis
+from config import CACHE_CONFIG
+
+_client = None
+
+def get_client():
+    """Return the shared Redis client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            CACHE_CONFIG['REDIS_URL'],
+            socket_timeout=CACHE_CONFIG['SOCKET_TIMEOUT'],
+            socket_connect_timeout=CACHE_CONFIG['SOCKET_TIMEOUT'],
+            decode_responses=True
+        )
+    return _client
+
+def make_key(namespace, *parts):
+    """Build a fixed-length cache key from the values that determine a result."""
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+    return f"{CACHE_CONFIG['KEY_PREFIX']}:{namespace}:{digest}"
+
+def cache_get(key):
+    """Return the cached string for key, or None on a miss or Redis error."""
+    try:
+        return get_client().get(key)
+    except redis.RedisError as e:
+        logging.warning(f"Cache read failed: {str(e)}")
+        return None
+
+def cache_set(key, value, ttl):
+    """Store a string for ttl seconds; Redis errors are logged and ignored."""
+    try:
+        get_client().set(key, value, ex=int(ttl))
+    except redis.RedisError as e:
+        logging.warning(f"Cache write failed: {str(e)}")
@@ -1,23 +1,55 @@
+import os
 from datetime import timedelta
 
 # Celery Configuration
 CELERY_CONFIG = {
     'BROKER_URL': 'redis://red-cuki0556l47c73cc9vi0:6379/0',
     'RESULT_BACKEND': 'redis://red-cuki0556l47c73cc9vi0:6379/0',
-    'BROKER_CONNECTION_RETRY_ON_STARTUP': True
+    'BROKER_CONNECTION_RETRY_ON_STARTUP': True,
+    'SERIALIZER': 'msgpack',
+    'ACCEPT_CONTENT': ['msgpack', 'json'],  # json drains messages queued before the switch
+    'RESULT_COMPRESSION': 'gzip',
+    'MAX_TASKS_PER_CHILD': 50,  # recycle worker processes to hand WeasyPrint's memory back to the OS
+    'MAX_MEMORY_PER_CHILD': 400 * 1024,  # KB
+    # Tasks run for a minute or more: hand each process one at a time so a free
+    # process never waits behind a busy one's prefetched backlog
+    'PREFETCH_MULTIPLIER': 1,
+    # Acking after the task keeps the prefetch limit at one message per process and
+    # redelivers tasks a stopped worker never finished. A child that is OOM-killed is
+    # still acked: REJECT_ON_WORKER_LOST stays off because a re-run pays for the story
+    # and images again, and a task that always crashes its process would loop forever.
+    'ACKS_LATE': True,
+    'REJECT_ON_WORKER_LOST': False
+}
+
+# Response Cache Configuration (separate Redis database from the Celery broker)
+CACHE_CONFIG = {
+    'REDIS_URL': 'redis://red-cuki0556l47c73cc9vi0:6379/1',
+    'KEY_PREFIX': 'story-cache',
+    'SOCKET_TIMEOUT': 0.5,  # seconds; a slow cache must not slow down generation
+    'STORY_TTL': timedelta(days=1).total_seconds(),
+    'SUMMARY_TTL': timedelta(days=1).total_seconds(),  # lives as long as the stories it describes
+    'ILLUSTRATION_TTL': timedelta(minutes=50).total_seconds(),  # Replicate delivery URLs expire after an hour
+    'TRANSLATION_TTL': timedelta(days=30).total_seconds()  # UI strings do not go stale
 }
 
 # Flask Configuration
 FLASK_CONFIG = {
     'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB
-    'CORS_ORIGINS': "*"
+    'CORS_ORIGINS': "*",
+    # PDFs are served straight from S3; this compresses the JSON API responses
+    'COMPRESS_ALGORITHM': ['br', 'gzip'],
+    'COMPRESS_MIMETYPES': ['application/json'],
+    'COMPRESS_MIN_SIZE': 500
 }
 
 # File Storage Configuration
 STORAGE_CONFIG = {
     'PDF_TEMP_DIR': '/tmp',
     'PDF_STORAGE_DIR': '/home/render/pdfs',
-    'S3_PDF_PREFIX': 'pdfs'
+    'TEMPLATE_CACHE_DIR': '/tmp/jinja_cache',
+    'S3_PDF_PREFIX': 'pdfs',
+    'MULTIPART_THRESHOLD': 8 * 1024 * 1024  # 8MB; smaller PDFs go up in a single PUT
 }
 
 # API Configuration
@@ -25,14 +57,43 @@ API_CONFIG = {
     'MISTRAL_MODEL': 'mistral-medium',
     'MAX_TOKENS': 800,
     'STORY_SECTIONS': 3,
-    'URL_EXPIRATION': timedelta(days=1).total_seconds()
+    'URL_EXPIRATION': timedelta(days=1).total_seconds(),
+    'MAX_CONCURRENT_REQUESTS': 8,
+    # Ask Mistral to summarize chapters that lack a scene line; otherwise use their opening sentences
+    'LLM_SUMMARIES': False,
+    'SUMMARY_MAX_TOKENS': 80,
+    'COMPLETION_CONTEXT_CHARS': 2000,  # story tail sent when asking for a missing ending
+    'MAX_RETRIES': 3,  # for rate limits, 5xx and dropped connections
+    'RETRY_BACKOFF': 0.5,
+    'RETRY_STATUSES': (429, 500, 502, 503, 504),  # retried honouring Retry-After
+    'TRANSLATION_TIMEOUT': (3.05, 30),  # (connect, read) seconds
+    'REQUEST_TIMEOUT': (5, 30),  # non-streamed calls; the read part grows with max_tokens
+    'MIN_TOKENS_PER_SECOND': 20,  # slowest generation a non-streamed call still waits for
+    'STREAM_TIMEOUT': (5, 30),  # read timeout is the longest allowed gap between streamed chunks
+    'MISTRAL_CONCURRENCY': int(os.getenv("MISTRAL_CONCURRENCY", 8))  # in-flight calls per process
 }
 
 # Image Generation Configuration
 IMAGE_CONFIG = {
-    'MODEL': 'stability-ai/stable-diffusion-3',
-    'WIDTH': 256,
-    'HEIGHT': 256
+    # Timestep-distilled model: 4 diffusion steps instead of ~28
+    'MODEL': 'black-forest-labs/flux-schnell',
+    'STEPS': 4,
+    'ASPECT_RATIO': '1:1',
+    'MEGAPIXELS': '0.25',  # smallest size offered, close to the old 256x256
+    'OUTPUT_FORMAT': 'jpg'
+}
+
+# PDF Rendering Configuration
+PDF_CONFIG = {
+    'FETCH_TIMEOUT': 10,  # seconds per illustration download
+    'FETCH_POOL_SIZE': 10,
+    # Recompress embedded illustrations; 96 DPI is plenty for a 300px-wide image
+    'OPTIMIZE_IMAGES': True,
+    'JPEG_QUALITY': 70,
+    'DPI': 96,
+    # Prefetched illustrations are shrunk to this bounding box and re-encoded as JPEG
+    'PREFETCH_MAX_SIZE': 512,
+    'PREFETCH_JPEG_QUALITY': 80
 }
 
 # Base URLs
@@ -0,0 +1,28 @@
+# generate_translations.py
+# Pre-translate the UI strings so these languages never wait on Mistral at request time:
+#   MISTRAL_API_KEY=... python generate_translations.py swedish polish
+# Review the generated files before committing them.
+import json
+import os
+import sys
+from language_handler import TRANSLATIONS_DIR, normalize_language, translate_language_config
+
+def main(languages):
+    for language in languages:
+        # Same name the request path looks up; only single-word names are ever loaded
+        language = normalize_language(language)
+        if not language.isalpha():
+            print(f"❌ {language!r}: only single-word language names can be loaded, nothing written")
+            continue
+        config, complete = translate_language_config(language)
+        if not complete:
+            print(f"❌ {language}: translation incomplete, nothing written")
+            continue
+        path = os.path.join(TRANSLATIONS_DIR, f"{language}.json")
+        with open(path, "w", encoding="utf-8") as translation_file:
+            json.dump(dict(config), translation_file, ensure_ascii=False, indent=4)
+            translation_file.write("\n")
+        print(f"✅ {language}: written to {path}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
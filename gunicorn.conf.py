@@ -0,0 +1,26 @@
+# gunicorn.conf.py
+# Start the web service with: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# Requests enqueue Celery tasks and poll Redis, so threads absorb the I/O waits
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = 120
+
+# Recycle workers periodically to cap memory growth
+max_requests = 100
+max_requests_jitter = 20
+
+# Import the app once in the master so workers share its pages copy-on-write
+preload_app = True
+
+def post_fork(server, worker):
+    """Drop keep-alive connections inherited from the master so workers never share sockets."""
+    import mistral_client
+    import pdf_renderer
+    mistral_client.MISTRAL_SESSION.close()
+    pdf_renderer.FETCH_SESSION.close()
@@ -1,8 +1,27 @@
 import logging
 import requests
 import os
-import re
+import string
+import threading
+from types import MappingProxyType
 import json
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from config import API_CONFIG, CACHE_CONFIG
+from cache import make_key, cache_get, cache_set
+from mistral_client import MISTRAL_CHAT_URL, MISTRAL_SEMAPHORE, MISTRAL_SESSION
+
+# Translations go through the shared Mistral session with the environment's key
+_AUTH_HEADERS = {"Authorization": f"Bearer {os.getenv('MISTRAL_API_KEY')}"}
+
+# Pre-generated configs for common languages (see generate_translations.py)
+TRANSLATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "translations")
+
+# Translated configs for custom languages, per process and bounded
+MAX_CUSTOM_CONFIGS = 64
+_custom_configs = {}
+_custom_configs_lock = threading.Lock()
 
 # Language configuration dictionary
 LANGUAGE_CONFIG = {
@@ -59,80 +78,199 @@ LANGUAGE_CONFIG = {
         "processing_message": "Aufgabe wird bearbeitet."
     }
 }
+# Read-only views: configs are shared by every request, so nobody may mutate them
+LANGUAGE_CONFIG = {language: MappingProxyType(config) for language, config in LANGUAGE_CONFIG.items()}
+
+# Enhanced prompts to enforce single language translation, without the indentation
+# that used to be sent (and billed) with every call
+TRANSLATOR_PROMPT = (
+    "You are a translator. You must ONLY translate to {target_language}. "
+    "Never translate to any other language. Return ONLY a JSON object with the translation. "
+    'Format: {{"translation": "your translated text"}}'
+)
+BATCH_TRANSLATOR_PROMPT = (
+    "You are a translator. You must ONLY translate to {target_language}. "
+    "Never translate to any other language. Return ONLY a JSON object with the same keys "
+    "as the input and the translated strings as values."
+)
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json_object(content):
+    """Return the first JSON object embedded in content, decoding in place; None if there is none."""
+    start = content.find('{')
+    while start >= 0:
+        try:
+            data, _ = _JSON_DECODER.raw_decode(content, start)
+            if isinstance(data, dict):
+                return data
+        except json.JSONDecodeError:
+            pass
+        start = content.find('{', start + 1)
+    return None
+
+def normalize_language(language):
+    """Canonical form of a language name: lowercase with single spaces."""
+    return " ".join(language.lower().split())
 
 def translate_with_mistral(text, target_language):
-    """Uses Mistral API to translate text with JSON output."""
-    try:
-        url = "https://api.mistral.ai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {os.getenv('MISTRAL_API_KEY')}",
-            "Content-Type": "application/json"
-        }
-        
-        # Enhanced prompt to enforce single language translation
-        system_prompt = f"""You are a translator. You must ONLY translate to {target_language}.
-        Never translate to any other language. Return ONLY a JSON object with the translation.
-        Format: {{"translation": "your translated text"}}"""
+    """Translate text, reusing earlier translations; falls back to the original text."""
+    # Normalized so "Chapter " and "Chapter", or " Italian" and "italian", share one entry
+    cache_key = make_key("translation", text.strip(), normalize_language(target_language))
+    cached_translation = cache_get(cache_key)
+    if cached_translation:
+        return cached_translation
 
+    translation = _request_translation(text, target_language)
+    if translation is None:
+        # Failures are not cached so the next request tries again
+        return text
+    cache_set(cache_key, translation, CACHE_CONFIG['TRANSLATION_TTL'])
+    return translation
+
+def _request_translation(text, target_language):
+    """Uses Mistral API to translate text with JSON output; returns None on failure."""
+    try:
         payload = {
-            "model": "mistral-medium",
+            "model": API_CONFIG['MISTRAL_MODEL'],
             "messages": [
                 {
                     "role": "system", 
-                    "content": system_prompt
+                    "content": TRANSLATOR_PROMPT.format(target_language=target_language)
                 },
                 {
                     "role": "user", 
                     "content": f"Translate ONLY to {target_language} and return ONLY a JSON object with the translation: '{text}'"
                 }
             ],
-            "max_tokens": 50,
-            "temperature": 0.1
+            # Room for the JSON wrapper plus a translation longer than the source
+            "max_tokens": max(32, min(256, 4 * len(text.split()) + 16)),
+            "temperature": 0.1,
+            # JSON mode guarantees a parseable object, so no text-scraping fallback is needed
+            "response_format": {"type": "json_object"}
         }
 
-        response = requests.post(url, json=payload, headers=headers)
-        response_json = response.json()
-
-        if "choices" in response_json and response_json["choices"]:
-            try:
-                content = response_json["choices"][0]["message"]["content"].strip()
-                translation_data = json.loads(content)
-                
-                if isinstance(translation_data, dict) and "translation" in translation_data:
-                    return translation_data["translation"]
-                
-            except json.JSONDecodeError:
-                content = response_json["choices"][0]["message"]["content"].strip()
-                if '"translation"' in content:
-                    try:
-                        json_start = content.find('{')
-                        json_end = content.rfind('}') + 1
-                        if json_start >= 0 and json_end > json_start:
-                            json_str = content[json_start:json_end]
-                            translation_data = json.loads(json_str)
-                            if "translation" in translation_data:
-                                return translation_data["translation"]
-                    except:
-                        pass
-                
-        return text
+        with MISTRAL_SEMAPHORE:
+            response = MISTRAL_SESSION.post(MISTRAL_CHAT_URL, data=orjson.dumps(payload), headers=_AUTH_HEADERS, timeout=API_CONFIG['TRANSLATION_TIMEOUT'])
+        if response.status_code != 200:
+            logging.error(f"Translation API error {response.status_code}: {response.text[:200]}")
+            return None
+        response_json = orjson.loads(response.content)
+        if not response_json.get("choices"):
+            return None
+
+        translation = orjson.loads(response_json["choices"][0]["message"]["content"]).get("translation")
+        return translation if isinstance(translation, str) and translation.strip() else None
 
+    except requests.Timeout:
+        logging.warning(f"Translation to {target_language} timed out for: {text[:50]}")
+        return None
     except Exception as e:
         logging.error(f"Translation Error: {str(e)}")
-        return text
+        return None
         
+def translate_batch_with_mistral(strings, target_language):
+    """
+    Translate a dict of UI strings in a single Mistral call.
+    Returns the translations that came back (possibly only some keys), or None if the response is unusable.
+    """
+    try:
+        payload = {
+            "model": API_CONFIG['MISTRAL_MODEL'],
+            "messages": [
+                {
+                    "role": "system",
+                    "content": BATCH_TRANSLATOR_PROMPT.format(target_language=target_language)
+                },
+                {
+                    "role": "user",
+                    "content": f"Translate these UI strings to {target_language}: {orjson.dumps(strings).decode()}"
+                }
+            ],
+            "max_tokens": 600,
+            "temperature": 0.1,
+            # JSON mode: the reply is a bare object, so the embedded-JSON scan is only a safety net
+            "response_format": {"type": "json_object"}
+        }
+
+        with MISTRAL_SEMAPHORE:
+            response = MISTRAL_SESSION.post(MISTRAL_CHAT_URL, data=orjson.dumps(payload), headers=_AUTH_HEADERS, timeout=API_CONFIG['TRANSLATION_TIMEOUT'])
+        if response.status_code != 200:
+            logging.error(f"Translation API error {response.status_code}: {response.text[:200]}")
+            return None
+        response_json = orjson.loads(response.content)
+        if not response_json.get("choices"):
+            return None
+
+        content = response_json["choices"][0]["message"]["content"].strip()
+        try:
+            translation_data = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            translation_data = _extract_json_object(content)
+
+        if not isinstance(translation_data, dict):
+            return None
+        # Keep every usable translation; the caller retries only the keys left out
+        return {
+            key: translation_data[key]
+            for key in strings
+            if isinstance(translation_data.get(key), str) and translation_data[key].strip()
+        }
+
+    except Exception as e:
+        logging.error(f"Batch Translation Error: {str(e)}")
+        return None
+
 def get_language_config(language='english', custom_language=None):
     """
     Get language configuration based on selected language.
     If it's a custom language, use that for translation.
     """
+    # Built-in keys are already canonical, so the common case skips normalizing
+    if not custom_language and language in LANGUAGE_CONFIG:
+        return LANGUAGE_CONFIG[language]
+
     # If custom_language is provided, use that instead of the standard language
-    target_language = custom_language.lower() if custom_language else language.lower()
+    target_language = normalize_language(custom_language or language)
     
     # First check if it's one of our predefined languages
     if not custom_language and target_language in LANGUAGE_CONFIG:
         return LANGUAGE_CONFIG[target_language]
-    
+
+    # Then for a translation shipped with the app; those never need a Mistral call
+    static_config = _load_static_config(target_language)
+    if static_config is not None:
+        return static_config
+
+    # Complete translations are kept per process and shared read-only, like LANGUAGE_CONFIG
+    custom_config = _custom_configs.get(target_language)
+    if custom_config is None:
+        custom_config, complete = translate_language_config(target_language)
+        custom_config = MappingProxyType(custom_config)
+        if complete:
+            with _custom_configs_lock:
+                if len(_custom_configs) >= MAX_CUSTOM_CONFIGS:
+                    _custom_configs.pop(next(iter(_custom_configs)))
+                _custom_configs[target_language] = custom_config
+    return custom_config
+
+@lru_cache(maxsize=64)
+def _load_static_config(language):
+    """Load translations/<language>.json if it exists; None otherwise."""
+    # The language comes from the request, so never let it form a path of its own
+    if not language.isalpha():
+        return None
+    try:
+        with open(os.path.join(TRANSLATIONS_DIR, f"{language}.json"), "rb") as translation_file:
+            return MappingProxyType(orjson.loads(translation_file.read()))
+    except FileNotFoundError:
+        return None
+
+def translate_language_config(target_language):
+    """
+    Translate the UI strings into target_language.
+    Returns (config, complete); incomplete configs may contain English and are not cached.
+    """
     # If we're here, we need to translate everything to the target language
     try:
         logging.info(f"Generating translations for language: {target_language}")
@@ -152,12 +290,28 @@ def get_language_config(language='english', custom_language=None):
             "processing_message": "Task is in progress."
         }
 
-        # Translate all strings
+        cache_key = make_key("language_config", target_language)
+        cached_config = cache_get(cache_key)
+        if cached_config:
+            logging.info(f"♻️ Language config for {target_language} served from cache")
+            return orjson.loads(cached_config), True
+
+        # One request for every string; per-string calls only cover keys the batch missed
+        translated = translate_batch_with_mistral(strings_to_translate, target_language) or {}
+        missing = [key for key in strings_to_translate if key not in translated]
+        if missing:
+            logging.warning(f"Batch translation for {target_language} missed {len(missing)} strings, translating them one by one")
+            max_workers = min(API_CONFIG['MAX_CONCURRENT_REQUESTS'], len(missing))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                translations = executor.map(
+                    lambda key: translate_with_mistral(strings_to_translate[key], target_language),
+                    missing
+                )
+                translated.update(zip(missing, translations))
+
         custom_config = {}
-        for key, text in strings_to_translate.items():
-            # Always pass the target_language to translate_with_mistral
-            translated_text = translate_with_mistral(text, target_language)
-            
+        for key in strings_to_translate:
+            translated_text = translated[key]
             # Handle placeholders for special cases
             if key == "story_title":
                 custom_config[key] = f"{translated_text} " + "{name}"
@@ -169,20 +323,51 @@ def get_language_config(language='english', custom_language=None):
             # Log for debugging
             logging.info(f"Translated {key} to {target_language}: {custom_config[key]}")
 
-        return custom_config
+        # Only a complete batch result is cached; fallback results may contain English
+        if not missing:
+            cache_set(cache_key, orjson.dumps(custom_config).decode(), CACHE_CONFIG['TRANSLATION_TTL'])
+        return custom_config, not missing
 
     except Exception as e:
         logging.error(f"Translation failed for language {target_language}: {str(e)}")
         logging.warning(f"Falling back to English due to translation error")
-        return LANGUAGE_CONFIG['english']
+        return LANGUAGE_CONFIG['english'], False
+
+class _KeepMissing(dict):
+    """format_map context that leaves unknown placeholders in place."""
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+_FORMATTER = string.Formatter()
+
+@lru_cache(maxsize=256)
+def _parse_template(value):
+    """
+    Parse a language string once into (literal, field) pairs.
+    Returns None for strings using format specs or conversions, which go through format_map.
+    """
+    plan = []
+    for literal, field, spec, conversion in _FORMATTER.parse(value):
+        if spec or conversion or (field is not None and not field.isidentifier()):
+            return None
+        plan.append((literal, field))
+    return tuple(plan)
 
 def format_language_strings(config, context):
-    """Format language strings with provided context."""
+    """Format language strings with provided context; unknown placeholders are kept as-is."""
+    context = _KeepMissing(context)
     formatted_config = {}
     for key, value in config.items():
-        try:
-            formatted_config[key] = value.format(**context)
-        except KeyError as e:
-            logging.error(f"Missing context key for formatting: {str(e)}")
+        # Most strings have no placeholders at all and are copied as-is
+        if "{" not in value and "}" not in value:
             formatted_config[key] = value
+            continue
+        plan = _parse_template(value)
+        if plan is None:
+            formatted_config[key] = value.format_map(context)
+        else:
+            formatted_config[key] = "".join(
+                literal if field is None else literal + str(context[field])
+                for literal, field in plan
+            )
     return formatted_config
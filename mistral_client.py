@@ -0,0 +1,29 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import API_CONFIG
+
+MISTRAL_CHAT_URL = "https://api.mistral.ai/v1/chat/completions"
+
+# Story, summary and translation calls share one per-process budget of in-flight
+# Mistral requests, so parallel fan-outs queue here instead of tripping rate limits
+MISTRAL_SEMAPHORE = threading.BoundedSemaphore(API_CONFIG['MISTRAL_CONCURRENCY'])
+
+# ...and one keep-alive pool, sized to that budget. Callers pass their own
+# Authorization header, since the story key and the translation key are configured separately.
+MISTRAL_SESSION = requests.Session()
+MISTRAL_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=API_CONFIG['MISTRAL_CONCURRENCY'],
+    max_retries=Retry(
+        total=API_CONFIG['MAX_RETRIES'],
+        # A read timeout means the generation ran and is billed; never send it again
+        read=0,
+        backoff_factor=API_CONFIG['RETRY_BACKOFF'],
+        status_forcelist=API_CONFIG['RETRY_STATUSES'],
+        allowed_methods=["POST"],
+        raise_on_status=False
+    )
+))
+MISTRAL_SESSION.headers.update({"Content-Type": "application/json"})
@@ -0,0 +1,86 @@
+import io
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from config import PDF_CONFIG
+
+# WeasyPrint (and Pango/Cairo behind it) is imported on first render, so the
+# web process, which never renders, does not carry it in memory
+_font_config = None
+
+# Keep-alive pool for illustration downloads made while rendering
+FETCH_SESSION = requests.Session()
+FETCH_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=PDF_CONFIG['FETCH_POOL_SIZE'],
+    pool_maxsize=PDF_CONFIG['FETCH_POOL_SIZE']
+))
+
+def get_font_config():
+    """Return the per-process FontConfiguration so font maps are built once."""
+    global _font_config
+    if _font_config is None:
+        from weasyprint.text.fonts import FontConfiguration
+        _font_config = FontConfiguration()
+    return _font_config
+
+def fetch_url(url):
+    """WeasyPrint URL fetcher that reuses pooled HTTP connections."""
+    if not url.startswith(("http://", "https://")):
+        from weasyprint import default_url_fetcher
+        return default_url_fetcher(url)
+    response = FETCH_SESSION.get(url, timeout=PDF_CONFIG['FETCH_TIMEOUT'])
+    response.raise_for_status()
+    result = {"string": response.content, "redirected_url": response.url}
+    mime_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if mime_type:
+        result["mime_type"] = mime_type
+    return result
+
+def prefetch_image(url):
+    """Download an image ahead of rendering; pass the results to render_pdf(prefetched=...)."""
+    fetched = fetch_url(url)
+    try:
+        return shrink_image(fetched)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not shrink illustration, embedding it as is: {str(e)}")
+        return fetched
+
+def shrink_image(fetched):
+    """Downscale a fetched image to the print size and re-encode it as JPEG."""
+    from PIL import Image
+    max_size = PDF_CONFIG['PREFETCH_MAX_SIZE']
+    with Image.open(io.BytesIO(fetched["string"])) as image:
+        if image.format == "JPEG" and max(image.size) <= max_size:
+            return fetched
+        image = image.convert("RGB")
+        image.thumbnail((max_size, max_size))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=PDF_CONFIG['PREFETCH_JPEG_QUALITY'], optimize=True)
+    return {"string": buffer.getvalue(), "redirected_url": fetched["redirected_url"], "mime_type": "image/jpeg"}
+
+def warm_up():
+    """Render a throwaway document to fill the font and CSS caches."""
+    from weasyprint import HTML
+    HTML(string="<p>warm-up</p>").write_pdf(font_config=get_font_config())
+    logging.info("✅ PDF renderer warmed up")
+
+def render_pdf(html, target=None, prefetched=None):
+    """
+    Render HTML to a PDF; returns the PDF bytes when no target is given.
+    `prefetched` maps URLs to prefetch_image() results that are served without a download.
+    """
+    from weasyprint import HTML
+    prefetched = prefetched or {}
+
+    def url_fetcher(url):
+        if url in prefetched:
+            return prefetched[url]
+        return fetch_url(url)
+
+    return HTML(string=html, url_fetcher=url_fetcher).write_pdf(
+        target,
+        font_config=get_font_config(),
+        optimize_images=PDF_CONFIG['OPTIMIZE_IMAGES'],
+        jpeg_quality=PDF_CONFIG['JPEG_QUALITY'],
+        dpi=PDF_CONFIG['DPI']
+    )
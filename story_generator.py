@@ -1,16 +1,76 @@
 import logging
+import orjson
 import requests
-from config import API_CONFIG, IMAGE_CONFIG, STORY_LENGTH_CONFIG
+from config import API_CONFIG, IMAGE_CONFIG, STORY_LENGTH_CONFIG, CACHE_CONFIG
+from cache import make_key, cache_get, cache_set
+from mistral_client import MISTRAL_CHAT_URL, MISTRAL_SEMAPHORE, MISTRAL_SESSION
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+@lru_cache(maxsize=32)
+def _chapter_regex(chapter_label):
+    """Compile the chapter-splitting pattern once per chapter label."""
+    return re.compile(rf"({re.escape(chapter_label)}\s*\d+[:.]?)", re.IGNORECASE)
+
+@lru_cache(maxsize=32)
+def _title_prefix_regex(chapter_label):
+    """Compile the pattern that strips a leading "Chapter N:" from titles."""
+    return re.compile(rf'{re.escape(chapter_label)}\s*\d+\s*:?\s*', re.IGNORECASE)
+
+_BOLD_RE = re.compile(r'\*\*.*?\*\*')
+
+# Sentence ends, except inside an ellipsis ("..." does not end the sentence)
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=(?<!\.)[.!?])\s+')
+
+# The story call also describes each chapter's key scene, so illustrations need no summary call
+SCENE_MARKER = "[[SCENE]]"
+# Markdown decoration around the marker ("**[[SCENE]]:** ...", "- [[SCENE]] ...") is tolerated
+_SCENE_RE = re.compile(
+    rf'^[ \t]*[-*_]*[ \t]*{re.escape(SCENE_MARKER)}[ \t*_]*:?[ \t*_]*(.*?)[ \t*_]*$',
+    re.MULTILINE | re.IGNORECASE
+)
+# Emphasis inside the scene text would reach the image prompt as stray asterisks
+_EMPHASIS_TABLE = str.maketrans('', '', '*_')
+
+# Phrases that show the story reached its ending, matched anywhere in the last lines
+ENDING_INDICATORS = ("The End", "Fin", "Ende", "concluded", "finally", "last", "happily ever after")
+_ENDING_RE = re.compile("|".join(re.escape(indicator) for indicator in ENDING_INDICATORS), re.IGNORECASE)
+
+# The fixed text comes first so every request shares the same prompt prefix
+SYSTEM_PROMPT = (
+    "You are an expert children's story writer. "
+    "Instructions may be in English, but write your final text ENTIRELY in {target_language} "
+    "and in no other language."
+)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You write concise scene descriptions for a children's book illustrator. "
+    "Write ENTIRELY in {target_language}."
+)
 
 class StoryGenerator:
+    __slots__ = ("api_key", "replicate_client", "auth_headers")
+
     def __init__(self, api_key, replicate_client):
         self.api_key = api_key
         self.replicate_client = replicate_client
+        # Built once; every call goes through the shared Mistral session
+        self.auth_headers = {"Authorization": f"Bearer {self.api_key}"}
 
-    def generate_story(self, prompt, chapter_label, story_length="short", target_language="english"):
-        """Generate story using Mistral API with length consideration and forced output language."""
+    def generate_story(self, prompt, chapter_label, story_length="short", target_language="english", on_chapter=None):
+        """
+        Generate story using Mistral API with length consideration and forced output language.
+        If on_chapter is given the story is streamed, and on_chapter(index, section) is called
+        for each chapter as soon as the next one starts, before the whole story has arrived.
+        """
         try:
+            cache_key = make_key("story", prompt, chapter_label, story_length, target_language)
+            cached_story = cache_get(cache_key)
+            if cached_story:
+                logging.info("♻️ Story served from cache")
+                return cached_story
+
             length_config = STORY_LENGTH_CONFIG[story_length]
             max_tokens = length_config["max_tokens"]
             target_sections = length_config["target_sections"]
@@ -19,21 +79,29 @@ class StoryGenerator:
                 f"{prompt}\n\n"
                 f"Structure the story into about {target_sections} chapters. "
                 f"Use \"{chapter_label} X:\" for each chapter. "
+                f"Right after each chapter title, add one line starting with {SCENE_MARKER} "
+                "that describes the chapter's key scene for an illustrator in one sentence. "
                 "Provide a complete story with a proper resolution."
             )
 
             response = self._call_mistral_api(
                 formatted_prompt, 
                 max_tokens=max_tokens, 
-                target_language=target_language
+                target_language=target_language,
+                on_delta=self._chapter_watcher(chapter_label, on_chapter) if on_chapter else None
             )
 
             if response:
-                story_text = response["choices"][0]["message"]["content"]
-                if self._verify_story_completion(story_text):
-                    return story_text
-                else:
-                    return self._ensure_story_completion(story_text, chapter_label, max_tokens, target_language=target_language)
+                choice = response["choices"][0]
+                story_text = choice["message"]["content"]
+                # Only a story that finished on its own is reused; cut-off or repaired ones are not
+                reusable = choice.get("finish_reason") == "stop"
+                if not self._verify_story_completion(story_text):
+                    story_text = self._ensure_story_completion(story_text, chapter_label, max_tokens, target_language=target_language)
+                    reusable = False
+                if reusable:
+                    cache_set(cache_key, story_text, CACHE_CONFIG['STORY_TTL'])
+                return story_text
 
             return "Error generating story."
         
@@ -41,27 +109,46 @@ class StoryGenerator:
             logging.error(f"Story generation error: {str(e)}")
             return f"Error generating story: {str(e)}"
 
+    def _chapter_watcher(self, chapter_label, on_chapter):
+        """Build a stream callback that reports each chapter once the following header arrives."""
+        chapter_regex = _chapter_regex(chapter_label)
+        text = ""
+        headers = []
+
+        def on_delta(delta):
+            nonlocal text
+            previous_length = len(text)
+            text += delta
+            # Only rescan the tail, allowing for a header split across deltas
+            search_from = max(headers[-1].end() if headers else 0, previous_length - 32)
+            for match in chapter_regex.finditer(text, search_from):
+                if match.end() == len(text):
+                    break  # the header may still be growing, e.g. "Chapter 2" before its ":"
+                if headers:
+                    previous = headers[-1]
+                    section = self._process_section([previous.group(1), text[previous.end():match.start()]], chapter_label)
+                    if section:
+                        on_chapter(len(headers) - 1, section)
+                headers.append(match)
+
+        return on_delta
+
     def _verify_story_completion(self, story_text):
         """Basic verification of story completion."""
-        ending_indicators = [
-            "The End",
-            "Fin",
-            "Ende",
-            "concluded",
-            "finally",
-            "last",
-            "happily ever after"
-        ]
-        last_paragraphs = story_text.split('\n')[-3:]
-        text_to_check = ' '.join(last_paragraphs).lower()
-        return any(indicator.lower() in text_to_check for indicator in ending_indicators)
+        text_to_check = ' '.join(story_text.rsplit('\n', 3)[-3:])
+        return _ENDING_RE.search(text_to_check) is not None
 
     def _ensure_story_completion(self, story_text, chapter_label, max_tokens, target_language="english"):
         """Attempt to generate a proper ending if needed."""
+        # The ending only needs the latest events, not the whole story re-sent as input
+        tail = story_text[-API_CONFIG['COMPLETION_CONTEXT_CHARS']:]
+        if len(tail) < len(story_text):
+            tail = tail.split(None, 1)[-1]  # do not start mid-word
         completion_prompt = f"""
-Complete this story with a proper ending (1-2 paragraphs maximum):
+Below is the ending of a children's story that stops before its resolution.
+Complete it with a proper ending (1-2 paragraphs maximum):
 
-{story_text}
+{tail}
 """
         response = self._call_mistral_api(completion_prompt, max_tokens=200, target_language=target_language)
         if response:
@@ -69,20 +156,20 @@ Complete this story with a proper ending (1-2 paragraphs maximum):
             return f"{story_text}\n\n{ending}"
         return story_text
 
-    def _call_mistral_api(self, prompt, max_tokens=None, target_language="english"):
-        """Make API call to Mistral and force output language."""
-        url = "https://api.mistral.ai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-    
-        system_content = (
-            f"You are an expert children's story writer. "
-            f"All user instructions may be in English, but you MUST produce your final story text "
-            f"ENTIRELY in {target_language}. "
-            f"Do not respond in any other language."
-        )
+    def _call_mistral_api(self, prompt, max_tokens=None, target_language="english", on_delta=None, system_prompt=SYSTEM_PROMPT):
+        """
+        Make API call to Mistral and force output language.
+        With on_delta the completion is streamed and each text delta is passed to it;
+        the return value has the same shape either way, including the choice's finish_reason.
+        """
+        system_content = system_prompt.format(target_language=target_language)
+        max_tokens = max_tokens or API_CONFIG['MAX_TOKENS']
+        if on_delta:
+            timeout = API_CONFIG['STREAM_TIMEOUT']
+        else:
+            # The whole completion arrives at once, so leave time to generate all of it
+            connect_timeout, read_timeout = API_CONFIG['REQUEST_TIMEOUT']
+            timeout = (connect_timeout, read_timeout + max_tokens / API_CONFIG['MIN_TOKENS_PER_SECOND'])
     
         payload = {
             "model": API_CONFIG['MISTRAL_MODEL'],
@@ -90,24 +177,91 @@ Complete this story with a proper ending (1-2 paragraphs maximum):
                 {"role": "system", "content": system_content},
                 {"role": "user", "content": prompt}
             ],
-            "max_tokens": max_tokens if max_tokens else API_CONFIG['MAX_TOKENS'],
-            "temperature": 0.7
+            "max_tokens": max_tokens,
+            "temperature": 0.7,
+            "stream": on_delta is not None
         }
     
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            return response.json()
-        return None
+        # A streamed story holds its slot until the last token has arrived
+        with MISTRAL_SEMAPHORE:
+            try:
+                response = MISTRAL_SESSION.post(
+                    MISTRAL_CHAT_URL, data=orjson.dumps(payload), headers=self.auth_headers,
+                    stream=on_delta is not None, timeout=timeout
+                )
+                if response.status_code != 200:
+                    logging.error(f"Mistral API error {response.status_code}: {response.text[:200]}")
+                    return None
+                if on_delta is None:
+                    return orjson.loads(response.content)
+                streamed = self._read_stream(response, on_delta)
+            except requests.RequestException as e:
+                logging.error(f"Mistral API request failed: {str(e)}")
+                return None
+        if streamed is None:
+            # The stream broke before any text, so no chapter was reported early either
+            logging.warning("⚠️ Mistral stream failed, retrying without streaming")
+            return self._call_mistral_api(prompt, max_tokens, target_language, system_prompt=system_prompt)
+        content, finish_reason = streamed
+        return {"choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}]}
+
+    def _read_stream(self, response, on_delta):
+        """
+        Collect the content of a server-sent-events completion, forwarding each delta.
+        Returns (content, finish_reason), or None if no text arrived. If the stream breaks
+        after some text arrived, that text is returned with finish_reason "error" so the
+        ending check can complete it instead of the whole story being lost.
+        """
+        parts = []
+        finish_reason = "error"
+        try:
+            with response:
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    event = orjson.loads(data)
+                    if not event.get("choices"):
+                        logging.error(f"Mistral stream error: {str(event)[:200]}")
+                        finish_reason = "error"
+                        break
+                    choice = event["choices"][0]
+                    finish_reason = choice.get("finish_reason") or finish_reason
+                    delta = choice.get("delta", {}).get("content")
+                    if delta:
+                        parts.append(delta)
+                        if on_delta:
+                            try:
+                                on_delta(delta)
+                            except Exception as e:
+                                # Early chapter work is an optimization; never let it cost the story
+                                logging.error(f"Stream callback failed, continuing without it: {str(e)}")
+                                on_delta = None
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            finish_reason = "error"
+            logging.warning(f"⚠️ Mistral stream interrupted after {len(parts)} chunks: {str(e)}")
+        if not parts:
+            return None
+        return "".join(parts), finish_reason
 
-    def split_into_sections(self, story_text, chapter_label, story_length="short", target_language="english"):
+    def split_into_sections(self, story_text, chapter_label, story_length="short", target_language="english", summarize=True):
         sections = []
-        chapter_regex = re.compile(rf"({chapter_label}\s*\d+[:.]?)", re.IGNORECASE)
-        parts = chapter_regex.split(story_text)[1:]
-        section_count = len(parts) // 2
-        for i in range(0, section_count * 2, 2):
-            section = self._process_section(parts[i:i+2], chapter_label, target_language)
+        headers = list(_chapter_regex(chapter_label).finditer(story_text))
+        # Each chapter runs from the end of its header to the start of the next one
+        for header, next_header in zip(headers, headers[1:] + [None]):
+            end = next_header.start() if next_header else len(story_text)
+            section = self._process_section([header.group(1), story_text[header.end():end]], chapter_label, target_language)
             if section:
                 sections.append(section)
+
+        # Only chapters without a scene line need a summary; LLM summaries run concurrently
+        missing = [section for section in sections if not section["summary"]]
+        if missing and summarize:
+            max_workers = min(API_CONFIG['MAX_CONCURRENT_REQUESTS'], len(missing))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(lambda section: self.summarize_section(section, target_language), missing))
         return sections
         
     def _process_section(self, part_pair, chapter_label, target_language="english"):
@@ -115,6 +269,11 @@ Complete this story with a proper ending (1-2 paragraphs maximum):
         if len(part_pair) < 2:
             return None
         chapter_number, content = part_pair
+        scene = _SCENE_RE.search(content)
+        summary = ""
+        if scene:
+            summary = scene.group(1).translate(_EMPHASIS_TABLE).strip()
+            content = _SCENE_RE.sub('', content)
         content = content.strip()
         content_parts = content.split('\n', 1)
         title = ""
@@ -126,30 +285,76 @@ Complete this story with a proper ending (1-2 paragraphs maximum):
             "chapter_number": chapter_number.strip().replace(":", ""),
             "title": title,
             "content": main_content,
-            "summary": self._generate_summary(main_content, target_language)
+            "summary": summary
         }
 
     def _clean_title(self, title, chapter_label):
         """Clean up chapter title."""
-        title = re.sub(r'\*\*.*?\*\*', '', title).strip()
-        return re.sub(rf'{chapter_label}\s*\d+\s*:?\s*', '', title, flags=re.IGNORECASE).strip()
+        title = _BOLD_RE.sub('', title).strip()
+        return _title_prefix_regex(chapter_label).sub('', title).strip()
+
+    def summarize_section(self, section, target_language="english"):
+        """Fill in a section's illustration summary if it does not have one yet."""
+        if not section.get("summary"):
+            if API_CONFIG['LLM_SUMMARIES']:
+                section["summary"] = self._generate_summary(section["content"], target_language)
+            else:
+                section["summary"] = self._first_sentences(section["content"])
+        return section
+
+    def _first_sentences(self, content, count=2, max_length=200):
+        """Cheap illustration summary: the opening sentences of the section."""
+        return " ".join(_SENTENCE_SPLIT_RE.split(content.strip(), maxsplit=count)[:count])[:max_length]
 
     def _generate_summary(self, content, target_language="english"):
         """Generate summary for illustrations."""
+        cache_key = make_key("summary", API_CONFIG['MISTRAL_MODEL'], content, target_language)
+        cached_summary = cache_get(cache_key)
+        if cached_summary:
+            return cached_summary
+
+        # A direct short call: none of the story framing, length checks or ending repair apply
         summary_prompt = f"Summarize this section in 2-3 sentences for an illustration: {content}"
-        return self.generate_story(summary_prompt, "Summary", story_length="short", target_language=target_language)
+        try:
+            response = self._call_mistral_api(
+                summary_prompt,
+                max_tokens=API_CONFIG['SUMMARY_MAX_TOKENS'],
+                target_language=target_language,
+                system_prompt=SUMMARY_SYSTEM_PROMPT
+            )
+            if not response:
+                return ""
+            summary = response["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            # A missing summary only costs this chapter its illustration
+            logging.error(f"Summary generation error: {str(e)}")
+            return ""
+        if summary:
+            cache_set(cache_key, summary, CACHE_CONFIG['SUMMARY_TTL'])
+        return summary
 
     def generate_illustration(self, prompt):
         """Generate illustration using Replicate."""
         try:
             input_data = {
                 "prompt": prompt,
-                "width": IMAGE_CONFIG['WIDTH'],
-                "height": IMAGE_CONFIG['HEIGHT']
+                "num_inference_steps": IMAGE_CONFIG['STEPS'],
+                "aspect_ratio": IMAGE_CONFIG['ASPECT_RATIO'],
+                "megapixels": IMAGE_CONFIG['MEGAPIXELS'],
+                "output_format": IMAGE_CONFIG['OUTPUT_FORMAT']
             }
-            
+            cache_key = make_key("illustration", IMAGE_CONFIG['MODEL'], *input_data.values())
+            cached_url = cache_get(cache_key)
+            if cached_url:
+                logging.info("♻️ Illustration served from cache")
+                return cached_url
+
             output = self.replicate_client.run(IMAGE_CONFIG['MODEL'], input=input_data)
-            return output[0] if output else None
+            if not output:
+                return None
+            illustration_url = str(output[0])
+            cache_set(cache_key, illustration_url, CACHE_CONFIG['ILLUSTRATION_TTL'])
+            return illustration_url
             
         except Exception as e:
             logging.error(f"Illustration generation error: {str(e)}")
@@ -1,22 +1,54 @@
 import os
 import logging
-import psutil
 from datetime import datetime
+from config import STORAGE_CONFIG
+
+_FILENAME_TABLE = str.maketrans(' ', '_')
 
 def sanitize_filename(filename):
     """Sanitize filename for safe storage."""
-    return filename.strip().replace(' ', '_')
+    return filename.strip().translate(_FILENAME_TABLE)
+
+def get_s3_key(filename, date_prefix=None):
+    """Generate S3 key with date prefix for an already sanitized filename."""
+    date_prefix = date_prefix or datetime.utcnow().strftime('%Y-%m-%d')
+    return f"{STORAGE_CONFIG['S3_PDF_PREFIX']}/{date_prefix}/{filename}"
+
+def get_content_s3_key(digest):
+    """Generate a content-addressed S3 key from a hex digest."""
+    return f"{STORAGE_CONFIG['S3_PDF_PREFIX']}/content/{digest}.pdf"
+
+# Memory profiling is opt-in: set MEM_DEBUG=1 to log RSS at each stage (at INFO, so it shows by default)
+MEM_DEBUG = os.getenv("MEM_DEBUG") == "1"
+_process = None
 
-def get_s3_key(filename):
-    """Generate S3 key with date prefix."""
-    date_prefix = datetime.utcnow().strftime('%Y-%m-%d')
-    return f"pdfs/{date_prefix}/{sanitize_filename(filename)}"
+def _current_process():
+    """Return a cached psutil.Process, rebuilt after a fork changes the pid."""
+    global _process
+    import psutil
+    if _process is None or _process.pid != os.getpid():
+        _process = psutil.Process()
+    return _process
+
+def _rss_bytes():
+    """Resident set size from /proc/self/statm, falling back to psutil off Linux."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return _current_process().memory_info().rss
 
 def log_memory_usage(stage):
     """Log memory usage at different stages."""
-    process = psutil.Process()
-    mem_info = process.memory_info()
-    logging.info(f"[{stage}] Memory Usage: {mem_info.rss / (1024 * 1024):.2f} MB")
+    if not MEM_DEBUG:
+        return
+    logging.info(f"[{stage}] Memory Usage: {_rss_bytes() / (1024 * 1024):.2f} MB")
+
+# Static storytelling instructions shared by every prompt
+STORY_GUIDELINES = (
+    "Include a surprising twist halfway through, an inspiring emotional moment, "
+    "vivid sensory descriptions, and suspense that keeps the child engaged."
+)
 
 def build_story_prompt(data, formatted_lang):
     """Build a richer, more original story prompt."""
@@ -31,13 +63,8 @@ def build_story_prompt(data, formatted_lang):
     if data.get('interests'):
         prompt_parts.append(f"The story should include themes about: {data['interests']}.")
 
-    # Add unpredictability: Twist, conflict, or surprise element
-    prompt_parts.append("Halfway through the story, introduce an unexpected event that changes everything!")
-    prompt_parts.append("Make sure the story has an emotional moment that leaves the child feeling inspired.")
-
-    # Encourage sensory details and immersive storytelling
-    prompt_parts.append("Use vibrant descriptions, making the reader feel like they are inside the world of the story.")
-    prompt_parts.append("Write in a way that keeps the child engaged, with suspense and excitement.")
+    # Twist, emotional payoff and immersive detail, phrased tersely to save input tokens
+    prompt_parts.append(STORY_GUIDELINES)
 
     # Genre-based customization
     if data.get('toggle-customization') == 'yes':